@@ -5,7 +5,7 @@
 # Created:
 #   16 Oct 2024, 17:32:14
 # Last edited:
-#   16 Oct 2024, 18:14:45
+#   14 Oct 2026, 04:54:22
 # Auto updated?
 #   Yes
 #
@@ -14,26 +14,44 @@
 #
 
 import argparse
+import contextlib
+import functools
+import itertools
+import mmap
 import os
+import re
+import shutil
+import stat
 import sys
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from io import TextIOWrapper
-from typing import Generator, List, Optional
+from typing import BinaryIO, ContextManager, Generator, Iterator, List, NamedTuple, Optional, Tuple, Union
 
 
 ##### GLOBALS #####
 # Whether to print additional debug statements or not.
 DEBUG: bool = False
 
+# The number of files analyzed by one task in the threadpool.
+BATCH_SIZE: int = 32
+# The size (in bytes) from which files are memory-mapped instead of read.
+MMAP_THRESHOLD: int = 1 << 20
+
 
 
 
 
 ##### HELPER FUNCTIONS #####
-def _supports_color():
+@functools.lru_cache(maxsize=1)
+def _supports_color() -> bool:
     """
         Returns True if the running system's terminal supports color, and False
         otherwise.
 
+        The result is cached, as it won't change while we run.
+
         From: https://stackoverflow.com/a/22254892
     """
     plat = sys.platform
@@ -43,7 +61,87 @@ def _supports_color():
     is_a_tty = hasattr(sys.stdout, 'isatty') and sys.stdout.isatty()
     return supported_platform and is_a_tty
 
-def pdebug(text: str, end: str = '\n', use_colour: Optional[bool] = None, file: TextIOWrapper = sys.stdout):
+def _abspath(path: str, cwd: str) -> str:
+    """
+        Canonicalizes the given path like `os.path.abspath()`, but relative to a given working
+        directory instead of calling `os.getcwd()` every time.
+
+        # Arguments
+        - `path`: The path to canonicalize.
+        - `cwd`: The (absolute) working directory to resolve relative paths against.
+
+        # Returns
+        The canonicalized `path`.
+    """
+    return os.path.normpath(path if os.path.isabs(path) else os.path.join(cwd, path))
+
+def _open_output(output: str) -> Tuple[BinaryIO, Optional[str], str]:
+    """
+        Opens the given output file for (binary) writing.
+
+        If the output is a regular file or doesn't exist yet, then a temporary file next to it is
+        opened instead, with the same permissions. It should be moved over the output with
+        `os.replace()` once complete, so that a failed run leaves the output untouched. Anything
+        else (e.g., `/dev/null`), or outputs in directories we can't create files in, are opened
+        directly.
+
+        # Arguments
+        - `output`: The path to the output file to open.
+
+        # Returns
+        A tuple of the opened handle, the path of the temporary file if any (else `None`), and the
+        resolved path of the output (i.e., with any symlinks followed).
+
+        # Errors
+        This function raises an `IOError` if we failed to open either file.
+    """
+
+    # Find out what the output is, following any symlinks to it
+    real = os.path.realpath(output)
+    try:
+        exists, regular = True, stat.S_ISREG(os.stat(real).st_mode)
+    except FileNotFoundError:
+        exists, regular = False, True
+
+    # Only (to-be) regular files are written through a temporary file
+    if regular:
+        try:
+            fd, temp = tempfile.mkstemp(dir=os.path.dirname(real), prefix=f".{os.path.basename(real)}.", suffix=".tmp")
+        except PermissionError:
+            pass
+        else:
+            try:
+                # Give it the permissions the output has, or would get when created normally
+                if exists:
+                    shutil.copymode(real, temp)
+                else:
+                    umask = os.umask(0)
+                    os.umask(umask)
+                    os.chmod(temp, 0o666 & ~umask)
+                return os.fdopen(fd, "wb", buffering=1 << 20), temp, real
+            except BaseException:
+                os.close(fd)
+                os.remove(temp)
+                raise
+    return open(output, "wb", buffering=1 << 20), None, real
+
+def _scandir_sorted(path: str) -> Iterator[os.DirEntry]:
+    """
+        Lists the entries of the given directory like `os.scandir()`, but sorted by name.
+
+        # Arguments
+        - `path`: The directory to list.
+
+        # Returns
+        An iterator over the `os.DirEntry`s in the directory.
+
+        # Errors
+        This function raises an `IOError` if we failed to read the directory.
+    """
+    with os.scandir(path) as entries:
+        return iter(sorted(entries, key=lambda entry: entry.name))
+
+def pdebug(text: str, end: str = '\n', use_colour: Optional[bool] = None, file: TextIOWrapper = sys.stdout) -> None:
     """
         Prints a message as if it's debug statements.
 
@@ -67,7 +165,7 @@ def pdebug(text: str, end: str = '\n', use_colour: Optional[bool] = None, file:
     # Print the message
     print(f"{accent}DEBUG: {text}{clear}", file=file, end=end)
 
-def perror(text: str, end: str = '\n', use_colour: Optional[bool] = None, file: TextIOWrapper = sys.stderr):
+def perror(text: str, end: str = '\n', use_colour: Optional[bool] = None, file: TextIOWrapper = sys.stderr) -> None:
     """
         Prints a message as if it's a fatal error.
 
@@ -94,7 +192,7 @@ def perror(text: str, end: str = '\n', use_colour: Optional[bool] = None, file:
 
 
 ##### HELPERS #####
-class Todo:
+class Todo(NamedTuple):
     # Whether its been done
     done: bool
     # Who does it
@@ -104,17 +202,31 @@ class Todo:
     # Where its gotten from
     file: str
 
-    def __init__(self, done: bool, who: str, what: str, file: str):
-        self.done = done
-        self.who = who
-        self.what = what
-        self.file = file
-
 
 
 
 
 ##### AUXILLARY FUNCTIONS #####
+def compile_todo_regex(who: str) -> "re.Pattern[bytes]":
+    """
+        Compiles the pattern matching a single TODO-line for the given person in a file, i.e.,
+        `- [ ] [<who>] <what>`.
+
+        The checkbox is optional, and if it's there, `x` means it's done. Like the original parser,
+        a line with a checkbox is never read as one without, so e.g. `- [x] [Bob] foo` is not an
+        open TODO `[Bob] foo` for `x`. By baking the person into the pattern, the lines of anyone
+        else are rejected by the regex engine already.
+
+        # Arguments
+        - `who`: The person to match the TODOs of.
+
+        # Returns
+        A compiled pattern that matches on (raw) file contents, and which captures:
+        1. `x` if the TODO is done (or nothing if it isn't); and
+        2. The description of the TODO.
+    """
+    return re.compile(rb"^- \[(?:(x)\] \[| \] \[|(?![x ]\] \[))" + re.escape(who.encode()) + rb"\](.*)$", re.MULTILINE)
+
 def get_markdown_files(path: str, exclude: List[str]) -> Generator[str, None, None]:
     """
         Generator for finding all markdown files in a tree path.
@@ -127,86 +239,142 @@ def get_markdown_files(path: str, exclude: List[str]) -> Generator[str, None, No
         Each of the files ending in `.md`.
     """
 
-    # Canonicalize all excluded directories
-    aexclude = []
-    for e in exclude:
+    # Canonicalize all excluded directories (against a working directory we only fetch once)
+    aexclude = set()
+    if len(exclude) > 0:
         try:
-            aexclude.append(os.path.abspath(e))
+            cwd = os.getcwd()
         except IOError as e:
-            perror(f"Failed to canonicalize to-be-excluded entry '{e}'")
+            perror(f"Failed to get the current working directory: {e}")
             return None
-
-    todo = [path]
+        for excl in exclude:
+            aexclude.add(_abspath(excl, cwd))
+
+    # Check the root itself, which may also be a (single) file. This is the only entry we
+    # canonicalize; for its children, we simply join their names to it. If there's nothing to
+    # exclude, though, we don't need the canonical paths at all (marked by `None`).
+    apath = None
+    if len(aexclude) > 0:
+        apath = _abspath(path, cwd)
+        if apath in aexclude:
+            pdebug(f"get_markdown_files(): Excluding '{path}'")
+            return None
+    if os.path.isfile(path):
+        pdebug(f"get_markdown_files(): Considering '{path}' as candidate Markdown file")
+        if path.endswith(".md"):
+            yield path
+        return None
+    elif not os.path.isdir(path):
+        perror(f"Path '{path}' is neither a file, nor a directory")
+        return None
+
+    # Go through the tree depth-first. We keep an iterator over the entries of every directory we're
+    # in on a stack (together with its displayed and canonical path). We use `scandir()` instead of
+    # `listdir()` because its entries already know their joined path, and so that the `is_*()`-checks
+    # below can use the cached type info instead of `stat()`ing. The entries are sorted by name, so
+    # that the order of the files (and thus the output) doesn't depend on the filesystem.
+    # Also, we check `DEBUG` before calling `pdebug()` in this loop, to avoid formatting messages
+    # per entry that won't be printed anyway.
+    pdebug(f"get_markdown_files(): Recursing into '{path}'")
+    try:
+        todo = [(_scandir_sorted(path), path, apath)]
+    except IOError as e:
+        perror(f"Failed to find entries of directory '{path}': {e}")
+        return None
     while len(todo) > 0:
-        p = todo.pop()
-
-        # Check if we should skip it
-        try:
-            if os.path.abspath(p) in aexclude:
-                pdebug(f"get_markdown_files(): Excluding '{p}'")
+        # Get the next entry in the current directory
+        entries, p, ap = todo[-1]
+        entry = next(entries, None)
+        if entry is None:
+            todo.pop()
+            continue
+
+        # Check if we should skip it (before recursing into it, if it's a directory)
+        aentry = None
+        if ap is not None:
+            aentry = os.path.join(ap, entry.name)
+            if aentry in aexclude:
+                if DEBUG: pdebug(f"get_markdown_files(): Excluding '{entry.path}'")
                 continue
-        except IOError as e:
-            perror(f"Failed to canonicalize entry '{p}'")
-            return None
 
-        # Decide what to do based on the type of the entry
-        if os.path.isfile(p):
-            pdebug(f"get_markdown_files(): Considering '{p}' as candidate Markdown file")
+        # Decide what to do based on the type of the entry. We check the name first, as that's
+        # cheaper and rules out most other files already.
+        is_md = entry.name.endswith(".md")
+        if is_md and entry.is_file():
+            if DEBUG: pdebug(f"get_markdown_files(): Considering '{entry.path}' as candidate Markdown file")
 
-            # It's a file; store if ending in `.md`
-            if len(p) >= 3 and p[-3:] == ".md":
-                yield p
-        elif os.path.isdir(p):
-            pdebug(f"get_markdown_files(): Recursing into '{p}'")
+            # It's a Markdown file; store it
+            yield entry.path
+        elif entry.is_dir():
+            if DEBUG: pdebug(f"get_markdown_files(): Recursing into '{entry.path}'")
 
-            # It's a directory; add the children
+            # It's a directory; recurse into it right away
             try:
-                todo += [os.path.join(p, entry) for entry in os.listdir(p)]
+                todo.append((_scandir_sorted(entry.path), entry.path, aentry))
             except IOError as e:
-                perror(f"Failed to find entries of directory '{p}': {e}")
+                perror(f"Failed to find entries of directory '{entry.path}': {e}")
                 return None
-        else:
-            perror(f"Path '{p}' is neither a file, nor a directory")
+        elif is_md:
+            perror(f"Path '{entry.path}' is neither a file, nor a directory")
             return None
 
-def analyze_todos_in_file(path: str, who: str) -> List[Todo]:
+def analyze_todos_in_file(path: str, who: str, regex: "re.Pattern[bytes]", needle: bytes) -> List[Todo]:
     """
         Finds the TODOs in the given file for the given person.
 
         # Arguments
         - `path`: The given file.
         - `who`: The given person.
+        - `regex`: The pattern matching the TODOs of `who`, as returned by `compile_todo_regex()`.
+        - `needle`: The `[<who>]`-tag (encoded) that any file with TODOs of `who` contains.
 
         # Returns
         A list of all found `Todo`s.
     """
 
-    # Read the file line-by-line
-    todos = []
-    with open(path, "r") as h:
-        for line in h.readlines():
-            # Check if the line Has What We Need TM
-            if len(line) >= 3 and line[:3] == "- [":
-                line = line[3:]
-
-                # Check if it's a checkbox
-                done = False
-                if len(line) >= 4 and line[:4] == "x] [":
-                    done = True
-                    line = line[4:]
-                elif len(line) >= 4 and line[:4] == " ] [":
-                    line = line[4:]
-
-                # Else, fetch the name
-                if (pos := line.find(']')) >= 0:
-                    name = line[:pos]
-                    line = line[pos + 1:]
-                else:
-                    continue
+    # Read the file in one go. Large files are memory-mapped instead, so that the regex can scan them
+    # straight from the page cache instead of from a copy.
+    with open(path, "rb") as h:
+        contents: ContextManager[Union[bytes, mmap.mmap]]
+        if os.fstat(h.fileno()).st_size >= MMAP_THRESHOLD:
+            contents = mmap.mmap(h.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            contents = contextlib.nullcontext(h.read())
 
-                # The rest is what
-                if name == who:
-                    todos.append(Todo(done, name, line.strip(), path))
+    # Scan it for TODOs; anything matching is already for `who`. Most notes won't have any TODOs for
+    # them at all, though, so we first check if the `needle` occurs in the file at all. That's a
+    # plain substring search, which is a lot faster than letting the regex try every line.
+    with contents as data:
+        if data.find(needle) < 0:
+            return []
+        return [Todo(m.group(1) is not None, who, m.group(2).decode().strip(), path) for m in regex.finditer(data)]
+
+def analyze_todos_in_files(paths: List[str], who: str, regex: "re.Pattern[bytes]", needle: bytes) -> List[Todo]:
+    """
+        Finds the TODOs in a batch of files for the given person, one file after another.
+
+        # Arguments
+        - `paths`: The given files.
+        - `who`: The given person.
+        - `regex`: The pattern matching the TODOs of `who`, as returned by `compile_todo_regex()`.
+        - `needle`: The `[<who>]`-tag (encoded) that any file with TODOs of `who` contains.
+
+        # Returns
+        A list of all found `Todo`s, in the order of the files.
+
+        # Errors
+        This function raises an `IOError` for the first file that failed to be analyzed. Its
+        `filename` is always set to that file.
+    """
+
+    todos = []
+    for path in paths:
+        try:
+            todos += analyze_todos_in_file(path, who, regex, needle)
+        except IOError as e:
+            # Make sure the caller knows which file it was
+            if e.filename is None: e.filename = path
+            raise
     return todos
 
 
@@ -236,32 +404,84 @@ def main(path: str, output: str, exclude: List[str], who: str, skip_done: bool)
     pdebug(f" - exclude : {exclude}")
     pdebug(f" - who     : \"{who}\"")
 
-    # Start analyzing the files
-    todos = []
-    for file in get_markdown_files(path, exclude):
-        try:
-            todos += analyze_todos_in_file(file, who)
-        except IOError as e:
-            perror(f"Failed to analyze file '{file}': {e}")
-            return e.errno
+    # Collect the files first, so that we can analyze them all in parallel
+    files = list(get_markdown_files(path, exclude))
 
-    # Write the result
+    # Open the output. We write it as raw bytes through a big buffer, to avoid encoding (and
+    # possibly flushing) every TODO separately. Since we write while still analyzing, regular files
+    # are first written to a temporary file next to them, which is only moved into their place once
+    # we're done (see `_open_output()`).
     if output == "-":
-        h = sys.stdout
+        sys.stdout.flush()
+        h, temp, real = sys.stdout.buffer, None, output
     else:
         try:
-            h = open(output, "w")
+            h, temp, real = _open_output(output)
         except IOError as e:
             perror(f"Failed to open '{output}' for writing: {e}")
             return e.errno
-    for todo in todos:
-        if skip_done and todo.done: continue
+
+    # Start analyzing the files. We do so in a threadpool to overlap the reading of them, where
+    # every task handles a batch of files to keep the overhead per task low. We write the results
+    # of every batch as soon as it (and everything before it) has been analyzed; this keeps the
+    # output deterministic without having to collect all TODOs first. To make sure the workers
+    # don't get too far ahead of us, we only ever have a few batches in flight, and drop every one
+    # of them (and its TODOs) as soon as it's written.
+    regex = compile_todo_regex(who)
+    # Any file with TODOs for `who` must contain this, which is much quicker to search for first
+    needle = b"[" + who.encode() + b"]"
+    # Every TODO we find is for `who`, so we can prepare the start of every output line already
+    done_prefix, todo_prefix = f"- [x] [{who}] ", f"- [ ] [{who}] "
+    success = False
+    try:
+        workers = 2 * (os.cpu_count() or 1)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            batches = (files[i:i + BATCH_SIZE] for i in range(0, len(files), BATCH_SIZE))
+            pending = deque(pool.submit(analyze_todos_in_files, batch, who, regex, needle) for batch in itertools.islice(batches, 2 * workers))
+            while len(pending) > 0:
+                future = pending.popleft()
+                if (batch := next(batches, None)) is not None:
+                    pending.append(pool.submit(analyze_todos_in_files, batch, who, regex, needle))
+                try:
+                    todos = future.result()
+                except IOError as e:
+                    perror(f"Failed to analyze file '{e.filename}': {e}")
+                    pool.shutdown(cancel_futures=True)
+                    return e.errno
+
+                # Write the result, in one go per batch
+                lines = [f"{done_prefix if todo.done else todo_prefix}{todo.what} ({todo.file})\n" for todo in todos if not (skip_done and todo.done)]
+                if len(lines) == 0: continue
+                try:
+                    h.write("".join(lines).encode())
+                except IOError as e:
+                    perror(f"Failed to write to '{output if output != '-' else 'stdout'}': {e}")
+                    pool.shutdown(cancel_futures=True)
+                    return e.errno
         try:
-            h.write(f"- [{'x' if todo.done else ' '}] [{todo.who}] {todo.what} ({todo.file})\n")
+            h.close()
         except IOError as e:
             perror(f"Failed to write to '{output if output != '-' else 'stdout'}': {e}")
             return e.errno
-    h.close()
+        success = True
+    finally:
+        # Don't leave a half-written output behind if we failed
+        if not success:
+            with contextlib.suppress(IOError):
+                h.close()
+            if temp is not None:
+                with contextlib.suppress(IOError):
+                    os.remove(temp)
+
+    # Put the output in its place now that it's complete
+    if temp is not None:
+        try:
+            os.replace(temp, real)
+        except IOError as e:
+            perror(f"Failed to move '{temp}' to '{output}': {e}")
+            with contextlib.suppress(IOError):
+                os.remove(temp)
+            return e.errno
 
     # Done!
     return 0